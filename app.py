@@ -1,7 +1,12 @@
 import os
+import time
+import click
 import sqlalchemy
-from flask import Flask, request, render_template, redirect, flash, url_for
-from data_manager.SQLite_data_manager import SQLiteDataManager
+from flask import (Flask, Response, request, render_template, redirect, flash, url_for,
+                   stream_with_context)
+from data_manager.SQLite_data_manager import (SQLiteDataManager, PartialImportError,
+                                             IMPORT_BATCH_SIZE, MAX_IMPORT_BATCH_SIZE)
+from data_transfer import FORMATS, serialize, parse, format_from_filename
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,17 +14,17 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY')
 
-# Configure SQLite URI
+# Configure SQLite URI, DATABASE_URI points the app at another database
 base_dir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{base_dir}/data/movies.sqlite"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI',
+                                                  f"sqlite:///{base_dir}/data/movies.sqlite")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Initialize DataManager
 data_manager = SQLiteDataManager(app)
 
-# Run once to create tables
-# with app.app_context():
-#     data.db.create_all()
+# Run `flask migrate-rating-stats` once to create the tables, or to update a database
+# created before personal ratings
 
 
 @app.route("/", methods=["GET"])
@@ -40,12 +45,13 @@ def list_users():
 
 @app.route("/movies", methods=["GET"])
 def list_movies():
-    """Display all movies in the database"""
-    movies = data_manager.get_all_movies()
+    """Display all movies in the database, ?sort=community sorts by community rating"""
+    sort_by = request.args.get('sort')
+    movies = data_manager.get_all_movies(sort_by=sort_by)
     message = request.args.get('message')
     if message:
         flash(message)
-    return render_template("movies.html", movies=movies, message=message)
+    return render_template("movies.html", movies=movies, message=message, sort_by=sort_by)
 
 
 @app.route("/users/<user_id>", methods=["GET"])
@@ -198,25 +204,33 @@ def update_movie(user_id, movie_id):
     if request.method == "GET":
         try:
             movie = data_manager.get_movie(movie_id)
-        except sqlalchemy.exc.NoResultFound:
+        except (sqlalchemy.exc.NoResultFound, ValueError):
             return redirect('/404')
-        return render_template('update_movie.html', movie=movie, user_id=user_id)
+        return render_template('update_movie.html', movie=movie, user_id=user_id,
+                               rating=data_manager.get_user_rating(movie_id, user_id))
 
     if request.method == "POST":
-        personal_rating = request.form.get('rating').strip()
-        movie = data_manager.get_movie(movie_id)
+        personal_rating = request.form.get('rating', '').strip()
+        try:
+            movie = data_manager.get_movie(movie_id)
+        except (sqlalchemy.exc.NoResultFound, ValueError):
+            return redirect('/404')
 
         try:
             data_manager.update_movie(movie_id=movie_id, user_id=user_id, rating=personal_rating)
+        except ValueError as e:
+            flash(f"{e}")
+            return render_template('update_movie.html', movie=movie, user_id=user_id,
+                                   rating=data_manager.get_user_rating(movie_id, user_id))
         except Exception as e:
             print(f"Error: {e}")
             flash("Error while updating movie. Try again!")
-            return render_template('update_movie.html', movie=data_manager.get_movie(movie_id),
-                                   user_id=user_id)
+            return render_template('update_movie.html', movie=movie, user_id=user_id,
+                                   rating=data_manager.get_user_rating(movie_id, user_id))
 
         flash(f"Movie '{movie.title}' has been updated successfully!")
         return render_template('update_movie.html', movie=data_manager.get_movie(movie_id),
-                               user_id=user_id)
+                               user_id=user_id, rating=data_manager.get_user_rating(movie_id, user_id))
 
 
 @app.route("/users/<user_id>/delete_movie/<movie_id>", methods=["GET"])
@@ -256,6 +270,116 @@ def like_movie(movie_id):
         return redirect(url_for('list_movies'))
 
 
+def export_response(records, file_format, filename):
+    """Streams the exported records as a file download"""
+    return Response(stream_with_context(serialize(records, file_format)),
+                    mimetype=FORMATS[file_format],
+                    headers={"Content-Disposition": f"attachment; filename={filename}.{file_format}"})
+
+
+@app.route("/movies/export", methods=["GET"])
+def export_movies():
+    """Download the whole movie catalog, ?format=ndjson (default) or csv"""
+    file_format = request.args.get('format', 'ndjson')
+    if file_format not in FORMATS:
+        return redirect('/404')
+    return export_response(data_manager.export_movies(), file_format, "movies")
+
+
+@app.route("/users/<user_id>/export", methods=["GET"])
+def export_user_movies(user_id):
+    """Download the movies of a user, ?format=ndjson (default) or csv"""
+    file_format = request.args.get('format', 'ndjson')
+    if file_format not in FORMATS:
+        return redirect('/404')
+    try:
+        records = data_manager.export_user_movies(user_id)
+    except (sqlalchemy.exc.NoResultFound, ValueError):
+        return redirect('/404')
+    return export_response(records, file_format, f"user_{user_id}_movies")
+
+
+def open_data_file(path, mode, file_format):
+    """Opens an export file, "-" is standard input/output. CSV files are opened without
+    newline translation, as the csv module handles line endings itself"""
+    if path == "-":
+        return click.open_file(path, mode, encoding="utf-8")
+    return open(path, mode, encoding="utf-8", newline="" if file_format == "csv" else None)
+
+
+@app.cli.command("export-movies")
+@click.option("--user-id", type=int, help="Export only the movies of this user.")
+@click.option("--format", "file_format", type=click.Choice(list(FORMATS)),
+              help="Output format, guessed from the output file name by default.")
+@click.option("--output", "output", type=click.Path(dir_okay=False), default="-",
+              help="Output file, standard output by default.")
+def export_movies_command(user_id, file_format, output):
+    """Exports the movie catalog or the movies of a user as NDJSON or CSV"""
+    file_format = file_format or format_from_filename(output)
+    try:
+        records = (data_manager.export_movies() if user_id is None
+                   else data_manager.export_user_movies(user_id))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    with open_data_file(output, "w", file_format) as file:
+        for line in serialize(records, file_format):
+            file.write(line)
+
+
+@app.cli.command("import-movies")
+@click.argument("source", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--user-id", type=int, help="Import all user movies into the library of this user.")
+@click.option("--format", "file_format", type=click.Choice(list(FORMATS)),
+              help="Input format, guessed from the file name by default.")
+@click.option("--batch-size", type=click.IntRange(1, MAX_IMPORT_BATCH_SIZE), default=IMPORT_BATCH_SIZE,
+              show_default=True, help="Rows written per transaction.")
+def import_movies_command(source, user_id, file_format, batch_size):
+    """Imports movies, users and user movies from an NDJSON or CSV export, without OMDb"""
+    file_format = file_format or format_from_filename(source)
+    start = time.perf_counter()
+    with open_data_file(source, "r", file_format) as file:
+        try:
+            imported = data_manager.import_records(parse(file, file_format), user_id=user_id,
+                                                   batch_size=batch_size)
+        except PartialImportError as e:
+            raise click.ClickException(f"{e} ({e.imported} rows imported before the error)")
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+    click.echo(f"Imported {imported} rows in {elapsed:.2f}s "
+               f"({imported / elapsed if elapsed else 0:.0f} rows/s).", err=True)
+
+
+@app.cli.command("migrate-rating-stats")
+def migrate_rating_stats():
+    """Creates missing tables, columns and indexes and rebuilds the rating aggregates"""
+    rebuilt = data_manager.migrate_rating_stats()
+    click.echo(f"Database is up to date, rebuilt rating aggregates of {rebuilt} movie(s).")
+
+
+@app.cli.command("check-rating-stats")
+@click.option("--rebuild", is_flag=True, help="Rebuild the aggregates that are out of date.")
+def check_rating_stats(rebuild):
+    """Checks the aggregated movie ratings against the personal ratings"""
+    inconsistent = data_manager.check_rating_stats()
+    if not inconsistent:
+        click.echo("All movie rating aggregates are consistent.")
+        return
+    click.echo(f"{len(inconsistent)} movie(s) with inconsistent rating aggregates: "
+               f"{', '.join(str(movie_id) for movie_id in inconsistent)}")
+    if rebuild:
+        rebuilt = data_manager.rebuild_rating_stats(inconsistent)
+        click.echo(f"Rebuilt rating aggregates of {rebuilt} movie(s).")
+
+
+@app.cli.command("rebuild-rating-stats")
+def rebuild_rating_stats():
+    """Rebuilds the aggregated ratings of all movies from the personal ratings"""
+    rebuilt = data_manager.rebuild_rating_stats()
+    click.echo(f"Rebuilt rating aggregates of {rebuilt} movie(s).")
+
+
 @app.errorhandler(404)
 def page_not_found(error):  # Accept the error argument
     """404 error handling route"""
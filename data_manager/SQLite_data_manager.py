@@ -1,8 +1,31 @@
+from itertools import islice
 from data_manager.data_manager_interface import DataManagerInterface
-from data_manager.data_models import User, Movie, UserMovie, db
+from data_manager.data_models import (User, Movie, UserMovie, MovieRatingStats, db,
+                                      MIN_RATING, MAX_RATING, RATING_BUCKETS, validate_rating)
+from sqlalchemy import (update, delete, insert, select, case, func, and_, bindparam, tuple_,
+                        inspect, text)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm.util import identity_key
 from movie_fetcher import movie_fetcher_omdb
 
+# Rows fetched per round trip while exporting, and rows written per transaction while importing.
+# An import batch binds two parameters per row, which has to stay below SQLite's limit of 32766.
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 5000
+MAX_IMPORT_BATCH_SIZE = 10000
+
+MOVIE_FIELDS = ("title", "release_year", "director", "rating", "poster", "link", "likes")
+
+
+class PartialImportError(ValueError):
+    """Invalid import record, the records before its batch have already been committed"""
+
+    def __init__(self, message, imported):
+        super().__init__(message)
+        self.imported = imported
+
 
 class SQLiteDataManager(DataManagerInterface):
     """SQLite database manager using sqlalchemy, inherits DataManagerInterface"""
@@ -30,12 +53,8 @@ class SQLiteDataManager(DataManagerInterface):
             if not user:
                 raise ValueError(f"User with ID {user_id} doesn't exist.")
 
-            movies = (
-                self.db.session.query(Movie)
-                .join(UserMovie, UserMovie.movie_id == Movie.id)
-                .filter(UserMovie.user_id == user_id)
-                .all()
-            )
+            # Each row holds the movie and the user's personal rating of it
+            movies = self._user_movies_query(user_id, Movie, UserMovie.rating).all()
 
             if not movies:
                 raise ValueError(f"There are no Movies for the given userID {user_id}.")
@@ -47,6 +66,15 @@ class SQLiteDataManager(DataManagerInterface):
             print(f"Error: {h}")
             raise
 
+    def _user_movies_query(self, user_id, *columns):
+        """Query selecting the given columns for every movie of a user"""
+        return (
+            self.db.session.query(*columns)
+            .select_from(UserMovie)
+            .join(Movie, UserMovie.movie_id == Movie.id)
+            .filter(UserMovie.user_id == user_id)
+        )
+
     def get_user(self, user_id):
         """Get a user by ID"""
 
@@ -82,12 +110,16 @@ class SQLiteDataManager(DataManagerInterface):
                 return f" User with ID {user_id} does not exist."
 
             # Get all movies associated with the user
-            user_movies = self.db.session.query(UserMovie).filter_by(user_id=user_id).all()
-            movie_ids = [user_movie.movie_id for user_movie in user_movies]
+            movie_ids = list(self.db.session.scalars(
+                select(UserMovie.movie_id).where(UserMovie.user_id == del_user.id).distinct()
+            ))
 
             # delete all UserMovie relationships for this user
             self.db.session.query(UserMovie).filter_by(user_id=user_id).delete()
 
+            # remove the user's ratings from the aggregated movie ratings in one statement
+            self._rebuild_rating_stats(movie_ids)
+
             # check if any of the movies are not associated with other users
             for movie_id in movie_ids:
                 is_movie_linked = self.db.session.query(UserMovie).filter_by(movie_id=movie_id).first()
@@ -160,8 +192,8 @@ class SQLiteDataManager(DataManagerInterface):
                     rating=movie_data['rating'],
                     poster=movie_data['poster'],
                     link=f"https://www.imdb.com/title/{movie_data['link']}",
-                    likes=likes
-
+                    likes=likes,
+                    rating_stats=MovieRatingStats()
                 )
                 self.db.session.add(new_movie)
                 self.db.session.commit()
@@ -180,17 +212,113 @@ class SQLiteDataManager(DataManagerInterface):
             return None  # Failure
 
     def update_movie(self, movie_id, user_id, rating=None):
-        """Update a movie in the database"""
+        """
+        Sets the personal rating of a user for a movie
+        and updates the movie's aggregated ratings in the same transaction
+        """
+        rating = validate_rating(rating)
         try:
-            update_movie = self.get_movie(movie_id)
-            if not update_movie:
-                print(f"Movie {movie_id} does not exist.")
-            update_movie.rating = rating
+            self._lock_user_movies(user_id, movie_id)
+            user_movie = (
+                self.db.session.query(UserMovie)
+                .filter_by(user_id=user_id, movie_id=movie_id)
+                .populate_existing()
+                .first()
+            )
+            if not user_movie:
+                self.db.session.rollback()
+                raise ValueError(f"Movie {movie_id} is not in the list of user {user_id}.")
+
+            self._apply_rating_change(user_movie.movie_id, old_rating=user_movie.rating,
+                                      new_rating=rating)
+            user_movie.rating = rating
             self.db.session.commit()
+            return user_movie
 
         except SQLAlchemyError as e:
             print(f"Error: {e}")
             self.db.session.rollback()
+            raise
+
+    def get_user_rating(self, movie_id, user_id):
+        """Gets the personal rating of a user for a movie, None if not rated"""
+        try:
+            return (
+                self.db.session.query(UserMovie.rating)
+                .filter_by(user_id=user_id, movie_id=movie_id)
+                .limit(1)
+                .scalar()
+            )
+        except SQLAlchemyError as e:
+            print(f"Error: {e}")
+            return None
+
+    def _lock_user_movies(self, user_id, movie_id=None):
+        """
+        Starts the write transaction with a no-op update of the user's movies.
+        pysqlite only begins a transaction on the first write, so without this the old
+        ratings would be read before SQLite's write lock is held. Doesn't commit.
+        """
+        query = update(UserMovie).where(UserMovie.user_id == user_id)
+        if movie_id is not None:
+            query = query.where(UserMovie.movie_id == movie_id)
+        self.db.session.execute(
+            query.values(rating=UserMovie.rating).execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def _rating_bucket(rating):
+        """Histogram bucket of a rating, the maximum rating falls into the last bucket"""
+        if not MIN_RATING <= rating <= MAX_RATING:
+            raise ValueError(f"Rating must be between {MIN_RATING} and {MAX_RATING}.")
+        return min(int(rating), RATING_BUCKETS - 1)
+
+    def _apply_rating_change(self, movie_id, old_rating=None, new_rating=None):
+        """
+        Replaces old_rating with new_rating in the aggregated ratings of a movie.
+        The update is relative to the stored values, old_rating has to be read
+        after _lock_user_movies so it can't change before the commit. Doesn't commit.
+        """
+        if old_rating is None and new_rating is None:
+            return
+
+        count_delta = (new_rating is not None) - (old_rating is not None)
+        sum_delta = (new_rating or 0.0) - (old_rating or 0.0)
+        new_count = MovieRatingStats.rating_count + count_delta
+        new_sum = MovieRatingStats.rating_sum + sum_delta
+
+        values = {
+            "rating_count": new_count,
+            "rating_sum": new_sum,
+            "rating_mean": case((new_count > 0, new_sum / new_count), else_=None),
+        }
+        bucket_deltas = {}
+        if old_rating is not None:
+            bucket = f"bucket_{self._rating_bucket(old_rating)}"
+            bucket_deltas[bucket] = bucket_deltas.get(bucket, 0) - 1
+        if new_rating is not None:
+            bucket = f"bucket_{self._rating_bucket(new_rating)}"
+            bucket_deltas[bucket] = bucket_deltas.get(bucket, 0) + 1
+        for bucket, delta in bucket_deltas.items():
+            if delta:
+                values[bucket] = getattr(MovieRatingStats, bucket) + delta
+
+        # Movies stored before the aggregates existed may not have a row yet
+        self.db.session.execute(
+            sqlite_insert(MovieRatingStats)
+            .values(movie_id=movie_id)
+            .on_conflict_do_nothing(index_elements=["movie_id"])
+        )
+        self.db.session.execute(
+            update(MovieRatingStats)
+            .where(MovieRatingStats.movie_id == movie_id)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        # Loaded stats objects are stale after the SQL update, look them up without a query
+        stats = self.db.session.identity_map.get(identity_key(MovieRatingStats, int(movie_id)))
+        if stats is not None:
+            self.db.session.expire(stats)
 
     def delete_movie(self, movie_id, user_id):
         """
@@ -198,17 +326,25 @@ class SQLiteDataManager(DataManagerInterface):
         if no other user has this movie, delete the movie from the database
         """
         try:
-            user_movie = self.db.session.query(UserMovie).filter_by(user_id=user_id,
-                                                                    movie_id=movie_id).first()
+            self._lock_user_movies(user_id, movie_id)
+            user_movie = (
+                self.db.session.query(UserMovie)
+                .filter_by(user_id=user_id, movie_id=movie_id)
+                .populate_existing()
+                .first()
+            )
 
             if not user_movie:
+                self.db.session.rollback()
                 return None  # None if no relationship between user and movie
 
             movie = self.db.session.query(Movie).filter_by(id=movie_id).first()
 
             if not movie:
+                self.db.session.rollback()
                 return None  # None if no movie exists with this ID
 
+            self._apply_rating_change(movie_id, old_rating=user_movie.rating)
             self.db.session.delete(user_movie)
 
             # If no other users has this movie
@@ -224,10 +360,22 @@ class SQLiteDataManager(DataManagerInterface):
             self.db.session.rollback()
             return None
 
-    def get_all_movies(self):
-        """Gets all the movies in the database"""
+    def get_all_movies(self, sort_by=None):
+        """
+        Gets all the movies in the database.
+        sort_by="community" orders them by the precomputed mean of personal ratings
+        """
         try:
-            return self.db.session.query(Movie).all()
+            query = self.db.session.query(Movie)
+            if sort_by == "community":
+                # The ordering join also fills the eagerly loaded relationship
+                query = (
+                    query.outerjoin(Movie.rating_stats)
+                    .options(contains_eager(Movie.rating_stats))
+                    .order_by(MovieRatingStats.rating_mean.desc().nulls_last(),
+                              MovieRatingStats.rating_count.desc(), Movie.id)
+                )
+            return query.all()
         except SQLAlchemyError as e:
             print(f"Error: {e}")
             return []
@@ -247,4 +395,307 @@ class SQLiteDataManager(DataManagerInterface):
         except SQLAlchemyError as e:
             print(f"Error: {e}")
             self.db.session.rollback()
-            return None
\ No newline at end of file
+            return None
+
+    def _aggregated_ratings(self, movie_ids=None):
+        """Select computing the rating aggregates of movies from the personal ratings"""
+        rating = UserMovie.rating
+        count = func.count(rating)
+        total = func.coalesce(func.sum(rating), 0.0)
+        columns = [
+            Movie.id.label("movie_id"),
+            count.label("rating_count"),
+            total.label("rating_sum"),
+            case((count > 0, total / count), else_=None).label("rating_mean"),
+        ]
+        for n in range(RATING_BUCKETS):
+            upper = rating < n + 1 if n < RATING_BUCKETS - 1 else rating.isnot(None)
+            in_bucket = and_(rating >= n, upper)
+            columns.append(func.coalesce(func.sum(case((in_bucket, 1), else_=0)), 0)
+                           .label(f"bucket_{n}"))
+
+        query = (
+            select(*columns)
+            .select_from(Movie)
+            .outerjoin(UserMovie, UserMovie.movie_id == Movie.id)
+            .group_by(Movie.id)
+        )
+        if movie_ids is not None:
+            query = query.where(Movie.id.in_(movie_ids))
+        return query
+
+    def check_rating_stats(self, movie_ids=None):
+        """
+        Compares the stored rating aggregates with the personal ratings.
+        Returns the IDs of the movies whose aggregates are missing or out of date.
+        """
+        try:
+            expected = self._aggregated_ratings(movie_ids).subquery()
+            rows = self.db.session.execute(
+                select(expected, MovieRatingStats)
+                .outerjoin(MovieRatingStats, MovieRatingStats.movie_id == expected.c.movie_id)
+            )
+            inconsistent = []
+            for row in rows:
+                stats = row.MovieRatingStats
+                histogram = [getattr(row, f"bucket_{n}") for n in range(RATING_BUCKETS)]
+                # Ratings outside of the buckets show up as a count the histogram doesn't add up to
+                if (stats is None or stats.histogram != histogram
+                        or sum(histogram) != row.rating_count):
+                    inconsistent.append(row.movie_id)
+                elif (stats.rating_count != row.rating_count
+                      or abs(stats.rating_sum - row.rating_sum) > 1e-6
+                      or (stats.rating_mean is None) != (row.rating_mean is None)
+                      or (stats.rating_mean is not None
+                          and abs(stats.rating_mean - row.rating_mean) > 1e-6)):
+                    inconsistent.append(row.movie_id)
+            return inconsistent
+
+        except SQLAlchemyError as e:
+            print(f"Error: {e}")
+            raise
+
+    def _rebuild_rating_stats(self, movie_ids=None):
+        """Replaces the rating aggregates of the movies in bulk, doesn't commit"""
+        stats_query = delete(MovieRatingStats)
+        if movie_ids is not None:
+            stats_query = stats_query.where(MovieRatingStats.movie_id.in_(movie_ids))
+        self.db.session.execute(stats_query)
+
+        aggregated = self._aggregated_ratings(movie_ids)
+        result = self.db.session.execute(
+            MovieRatingStats.__table__.insert().from_select(
+                [column.name for column in aggregated.selected_columns], aggregated
+            )
+        )
+        return result.rowcount
+
+    def rebuild_rating_stats(self, movie_ids=None):
+        """
+        Recomputes the rating aggregates from the personal ratings in bulk,
+        for all movies or only the given movie IDs. Returns the number of rebuilt movies.
+        """
+        try:
+            rebuilt = self._rebuild_rating_stats(movie_ids)
+            self.db.session.commit()
+            self.db.session.expire_all()
+            return rebuilt
+
+        except SQLAlchemyError as e:
+            print(f"Error: {e}")
+            self.db.session.rollback()
+            raise
+
+    def migrate_rating_stats(self):
+        """
+        Brings a database created before personal ratings up to date: creates missing tables,
+        adds user_movies.rating and the new indexes, then rebuilds all rating aggregates.
+        Safe to run more than once. Returns the number of rebuilt movies.
+        """
+        try:
+            engine = self.db.engine
+            self.db.create_all()
+            user_movie_columns = {column["name"]
+                                  for column in inspect(engine).get_columns("user_movies")}
+            with engine.begin() as connection:
+                if "rating" not in user_movie_columns:
+                    connection.execute(text("ALTER TABLE user_movies ADD COLUMN rating FLOAT"))
+                for table in (Movie.__table__, UserMovie.__table__, MovieRatingStats.__table__):
+                    for index in table.indexes:
+                        index.create(connection, checkfirst=True)
+        except SQLAlchemyError as e:
+            print(f"Error: {e}")
+            raise
+        return self.rebuild_rating_stats()
+
+    @staticmethod
+    def _stream(query, batch_size):
+        """Yields the rows of a query as dicts, fetching batch_size rows at a time"""
+        for row in query.yield_per(batch_size):
+            yield row._asdict()
+
+    def export_movies(self, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Generator over all movies of the catalog as dicts.
+        Rows are streamed from a server-side cursor, so memory use doesn't grow with the catalog.
+        """
+        query = (
+            self.db.session.query(*(getattr(Movie, field) for field in MOVIE_FIELDS))
+            .order_by(Movie.id)
+        )
+        return self._stream(query, batch_size)
+
+    def export_user_movies(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Generator over the movies of a user as dicts, including the personal rating.
+        Raises ValueError right away if the user doesn't exist.
+        """
+        user = self.get_user(user_id)
+        query = (
+            self._user_movies_query(
+                user.id,
+                UserMovie.user_id, User.name.label("user_name"),
+                UserMovie.rating.label("personal_rating"),
+                *(getattr(Movie, field) for field in MOVIE_FIELDS)
+            )
+            .join(User, UserMovie.user_id == User.id)
+            .order_by(UserMovie.id)
+        )
+        return self._stream(query, batch_size)
+
+    def import_records(self, records, user_id=None, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Upserts exported records without calling OMDb, one transaction per batch.
+        Movies are matched by title and release year, users by ID. If user_id is given,
+        all movies with a user go to the library of that (existing) user instead.
+        Empty fields, including personal ratings, never overwrite stored values.
+        Returns the number of imported records.
+
+        Batches are committed as they are imported, an invalid record only rolls back its own
+        batch. The PartialImportError raised for it tells how many records were committed before.
+        """
+        if not 0 < batch_size <= MAX_IMPORT_BATCH_SIZE:
+            raise ValueError(f"Batch size must be between 1 and {MAX_IMPORT_BATCH_SIZE}.")
+        if user_id is not None:
+            user_id = self.get_user(user_id).id
+
+        records = iter(records)
+        imported = 0
+        while True:
+            try:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    return imported
+                if user_id is not None:
+                    for record in batch:
+                        if record.get("user_id") is not None or record.get("user_name"):
+                            record["user_id"] = user_id
+                self._import_batch(batch, keep_user_names=user_id is None)
+                self.db.session.commit()
+            except ValueError as e:
+                self.db.session.rollback()
+                raise PartialImportError(str(e), imported) from e
+            except SQLAlchemyError as e:
+                print(f"Error after {imported} imported records: {e}")
+                self.db.session.rollback()
+                raise
+            self.db.session.expunge_all()
+            imported += len(batch)
+
+    def _import_batch(self, batch, keep_user_names=True):
+        """Upserts the movies, users and user movies of one batch of records, doesn't commit"""
+        for record in batch:
+            if not record.get("title"):
+                raise ValueError(f"Record without a title can't be imported: {record}")
+            try:
+                record["personal_rating"] = validate_rating(record.get("personal_rating"))
+            except ValueError as e:
+                raise ValueError(f"Record with an invalid personal rating can't be imported: "
+                                 f"{record}: {e}")
+
+        movie_ids = self._upsert_movies(batch)
+        self._upsert_users(batch, update_names=keep_user_names)
+
+        # The last rating of a user and movie wins, empty ratings don't replace any
+        ratings = {}
+        for record in batch:
+            if record.get("user_id") is not None:
+                key = (record["user_id"], movie_ids[(record["title"], record.get("release_year"))])
+                rating = record.get("personal_rating")
+                ratings[key] = rating if rating is not None else ratings.get(key)
+        if not ratings:
+            return
+
+        # Look up exactly the pairs of the batch, filtering on user and movie IDs
+        # separately would probe the index for every combination of both
+        existing = {}
+        for user_movie_id, key_user_id, movie_id in self.db.session.execute(
+                select(UserMovie.id, UserMovie.user_id, UserMovie.movie_id)
+                .where(tuple_(UserMovie.user_id, UserMovie.movie_id).in_(list(ratings)))
+                .order_by(UserMovie.id)):
+            existing.setdefault((key_user_id, movie_id), user_movie_id)
+
+        user_movies = UserMovie.__table__
+        updates = [(existing[key], rating) for key, rating in ratings.items() if key in existing]
+        inserts = [{"user_id": key[0], "movie_id": key[1], "rating": rating}
+                   for key, rating in ratings.items() if key not in existing]
+        if updates:
+            # Like the movie fields, an empty rating keeps the stored one
+            self.db.session.execute(
+                update(user_movies).where(user_movies.c.id == bindparam("b_id"))
+                .values(rating=func.coalesce(bindparam("b_rating"), user_movies.c.rating)),
+                [{"b_id": user_movie_id, "b_rating": rating} for user_movie_id, rating in updates]
+            )
+        if inserts:
+            self.db.session.execute(insert(user_movies), inserts)
+
+        self._rebuild_rating_stats({key[1] for key in ratings})
+
+    def _upsert_movies(self, batch):
+        """Upserts the movies of a batch, returns their IDs by (title, release_year)"""
+        movies = {}
+        for record in batch:
+            key = (record["title"], record.get("release_year"))
+            values = {field: record[field] for field in MOVIE_FIELDS if record.get(field) is not None}
+            movies.setdefault(key, {}).update(values)
+
+        movie_table = Movie.__table__
+        movie_ids = self._movie_ids({key[0] for key in movies})
+        new_movies = [key for key in movies if key not in movie_ids]
+
+        # Every update row binds all fields, missing ones keep the stored value
+        updates = [dict({f"b_{field}": values.get(field) for field in MOVIE_FIELDS},
+                        b_id=movie_ids[key])
+                   for key, values in movies.items() if key in movie_ids]
+        if updates:
+            self.db.session.execute(
+                update(movie_table).where(movie_table.c.id == bindparam("b_id"))
+                .values({field: func.coalesce(bindparam(f"b_{field}"), movie_table.c[field])
+                         for field in MOVIE_FIELDS}),
+                updates
+            )
+        if new_movies:
+            defaults = dict.fromkeys(MOVIE_FIELDS) | {"rating": 0.0, "likes": 0}
+            self.db.session.execute(insert(movie_table), [defaults | movies[key] for key in new_movies])
+            movie_ids = self._movie_ids({key[0] for key in movies})
+            # New movies start with empty rating aggregates
+            self.db.session.execute(insert(MovieRatingStats.__table__),
+                                    [{"movie_id": movie_ids[key]} for key in new_movies])
+        return movie_ids
+
+    def _movie_ids(self, titles):
+        """IDs of the movies with the given titles by (title, release_year), oldest movie first"""
+        movie_ids = {}
+        for movie_id, title, release_year in self.db.session.execute(
+                select(Movie.id, Movie.title, Movie.release_year)
+                .where(Movie.title.in_(titles))
+                .order_by(Movie.id)):
+            movie_ids.setdefault((title, release_year), movie_id)
+        return movie_ids
+
+    def _upsert_users(self, batch, update_names=True):
+        """Creates the users of a batch that don't exist yet and updates the names of the others"""
+        names = {}
+        for record in batch:
+            if record.get("user_id") is not None:
+                names[record["user_id"]] = record.get("user_name") or names.get(record["user_id"])
+        if not names:
+            return
+
+        existing = set(self.db.session.scalars(select(User.id).where(User.id.in_(names))))
+        missing = [user_id for user_id in names if user_id not in existing]
+        if any(not names[user_id] for user_id in missing):
+            raise ValueError("Records of a new user need a user_name.")
+        users = User.__table__
+        if missing:
+            self.db.session.execute(insert(users), [{"id": user_id, "name": names[user_id]}
+                                                    for user_id in missing])
+        if update_names:
+            updates = [{"b_id": user_id, "b_name": names[user_id]}
+                       for user_id in existing if names[user_id]]
+            if updates:
+                self.db.session.execute(
+                    update(users).where(users.c.id == bindparam("b_id"))
+                    .values(name=bindparam("b_name")),
+                    updates
+                )
@@ -48,9 +48,37 @@ class DataManagerInterface(ABC):
         pass
 
     @abstractmethod
-    def get_all_movies(self):
+    def get_user_rating(self, movie_id, user_id):
+        pass
+
+    @abstractmethod
+    def get_all_movies(self, sort_by):
         pass
 
     @abstractmethod
     def like_movie(self, movie_id):
-        pass
\ No newline at end of file
+        pass
+
+    @abstractmethod
+    def check_rating_stats(self, movie_ids):
+        pass
+
+    @abstractmethod
+    def rebuild_rating_stats(self, movie_ids):
+        pass
+
+    @abstractmethod
+    def migrate_rating_stats(self):
+        pass
+
+    @abstractmethod
+    def export_movies(self, batch_size):
+        pass
+
+    @abstractmethod
+    def export_user_movies(self, user_id, batch_size):
+        pass
+
+    @abstractmethod
+    def import_records(self, records, user_id, batch_size):
+        pass
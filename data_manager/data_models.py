@@ -1,9 +1,27 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index
 from sqlalchemy.orm import relationship
 
 db = SQLAlchemy()
 
+# Personal ratings range from 0 to 10, one histogram bucket per point
+MIN_RATING = 0
+MAX_RATING = 10
+RATING_BUCKETS = 10
+
+
+def validate_rating(rating):
+    """Converts a personal rating to float, empty ratings become None"""
+    if rating is None or str(rating).strip() == "":
+        return None
+    try:
+        rating = float(rating)
+    except ValueError:
+        raise ValueError(f"Rating '{rating}' is not a number.")
+    if not MIN_RATING <= rating <= MAX_RATING:
+        raise ValueError(f"Rating must be between {MIN_RATING} and {MAX_RATING}.")
+    return rating
+
 
 class User(db.Model):
     """
@@ -33,7 +51,7 @@ class Movie(db.Model):
     __tablename__ = "movies"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    title = Column(String, nullable=False)
+    title = Column(String, nullable=False, index=True)
     release_year = Column(Integer, nullable=True)
     director = Column(String, nullable=True)
     rating = Column(Float, nullable=False)
@@ -44,6 +62,10 @@ class Movie(db.Model):
     # Relationship with UserMovie
     user_movies = relationship('UserMovie', back_populates='movie', cascade='all, delete')
 
+    # Precomputed community rating, loaded together with the movie
+    rating_stats = relationship('MovieRatingStats', back_populates='movie', uselist=False,
+                                lazy='joined', cascade='all, delete-orphan')
+
     def __str__(self):
         """Human-readable string representation of the model Movie"""
         return f"{self.id}. {self.title}, {self.release_year}"
@@ -60,10 +82,12 @@ class UserMovie(db.Model):
     Model for relationship between users and movies
     """
     __tablename__ = 'user_movies'
+    __table_args__ = (Index('ix_user_movies_user_id_movie_id', 'user_id', 'movie_id'),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False)
+    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False, index=True)
+    rating = Column(Float, nullable=True)  # Personal rating of the user
 
     # Relationships
     user = relationship('User', back_populates='user_movies')
@@ -71,4 +95,44 @@ class UserMovie(db.Model):
 
     def __repr__(self):
         """Returns a string representation of the UserMovie model, debugging-friendly"""
-        return f"UserMovie(id = {self.id}, user_id = {self.user_id}, movie_id = {self.movie_id})"
\ No newline at end of file
+        return (f"UserMovie(id = {self.id}, user_id = {self.user_id}, movie_id = {self.movie_id}, "
+                f"rating = {self.rating})")
+
+
+class MovieRatingStats(db.Model):
+    """
+    Model for the aggregated personal ratings of a movie,
+    kept up to date together with every rating write
+    """
+    __tablename__ = 'movie_rating_stats'
+
+    movie_id = Column(Integer, ForeignKey('movies.id'), primary_key=True)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Float, nullable=False, default=0.0)
+    rating_mean = Column(Float, nullable=True, index=True)
+
+    # Histogram of ratings, bucket_n counts ratings in [n, n + 1), bucket_9 includes 10
+    bucket_0 = Column(Integer, nullable=False, default=0)
+    bucket_1 = Column(Integer, nullable=False, default=0)
+    bucket_2 = Column(Integer, nullable=False, default=0)
+    bucket_3 = Column(Integer, nullable=False, default=0)
+    bucket_4 = Column(Integer, nullable=False, default=0)
+    bucket_5 = Column(Integer, nullable=False, default=0)
+    bucket_6 = Column(Integer, nullable=False, default=0)
+    bucket_7 = Column(Integer, nullable=False, default=0)
+    bucket_8 = Column(Integer, nullable=False, default=0)
+    bucket_9 = Column(Integer, nullable=False, default=0)
+
+    # Relationship with Movie
+    movie = relationship('Movie', back_populates='rating_stats')
+
+    @property
+    def histogram(self):
+        """Returns the bucket counts as a list, index n is the bucket [n, n + 1)"""
+        return [getattr(self, f"bucket_{n}") for n in range(RATING_BUCKETS)]
+
+    def __repr__(self):
+        """Returns a string representation of the MovieRatingStats model, debugging-friendly"""
+        return (f"MovieRatingStats(movie_id = {self.movie_id}, rating_count = {self.rating_count}, "
+                f"rating_sum = {self.rating_sum}, rating_mean = {self.rating_mean}, "
+                f"histogram = {self.histogram})")
\ No newline at end of file
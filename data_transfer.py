@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+from data_manager.data_models import validate_rating
+
+# Columns of an exported row, catalog rows leave the user columns empty
+EXPORT_FIELDS = [
+    "user_id", "user_name", "personal_rating",
+    "title", "release_year", "director", "rating", "poster", "link", "likes",
+]
+INTEGER_FIELDS = {"user_id", "likes"}
+FLOAT_FIELDS = {"personal_rating", "rating"}
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def format_from_filename(filename, default="ndjson"):
+    """Guess the export format from a file extension"""
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if extension in ("ndjson", "jsonl"):
+        return "ndjson"
+    if extension == "csv":
+        return "csv"
+    return default
+
+
+def to_ndjson(records):
+    """Yields one JSON line per record"""
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def to_csv(records):
+    """Yields the CSV header followed by one CSV line per record"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+def serialize(records, file_format):
+    """Yields the records as lines of the given format"""
+    if file_format == "ndjson":
+        return to_ndjson(records)
+    if file_format == "csv":
+        return to_csv(records)
+    raise ValueError(f"Unsupported format '{file_format}', use one of: {', '.join(FORMATS)}.")
+
+
+def _convert(field, value):
+    """Converts a CSV/JSON value to the type of the column, empty values become None"""
+    if value is None or value == "":
+        return None
+    if field == "personal_rating":
+        return validate_rating(value)
+    if field == "release_year":
+        # OMDb years of series like "2010–2017" are stored as text and kept as is
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    if field in INTEGER_FIELDS:
+        return int(float(value))
+    if field in FLOAT_FIELDS:
+        return float(value)
+    return value
+
+
+def _clean(record):
+    """Keeps the known fields of a record with converted values"""
+    return {field: _convert(field, record.get(field)) for field in EXPORT_FIELDS}
+
+
+def read_ndjson(lines):
+    """Yields a record for every non-empty JSON line"""
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield _clean(json.loads(line))
+        except (ValueError, AttributeError) as e:
+            raise ValueError(f"Invalid record on line {line_number}: {e}")
+
+
+def read_csv(lines):
+    """Yields a record for every CSV row after the header"""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        try:
+            yield _clean(row)
+        except ValueError as e:
+            raise ValueError(f"Invalid record on line {reader.line_num}: {e}")
+
+
+def parse(lines, file_format):
+    """Yields the records read lazily from lines of the given format"""
+    if file_format == "ndjson":
+        return read_ndjson(lines)
+    if file_format == "csv":
+        return read_csv(lines)
+    raise ValueError(f"Unsupported format '{file_format}', use one of: {', '.join(FORMATS)}.")
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Point app.py at a throwaway database before any test imports it
+os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'movies.sqlite')}"
+os.environ.setdefault("SECRET_KEY", "test")
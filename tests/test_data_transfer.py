@@ -0,0 +1,184 @@
+import io
+import json
+import pytest
+import app as movie_app
+from data_manager.SQLite_data_manager import PartialImportError
+from data_manager.data_models import db, Movie, User, UserMovie, MovieRatingStats
+from data_transfer import serialize, parse
+
+
+@pytest.fixture
+def data_manager():
+    """Data manager of the app on an empty database with a user library including a series"""
+    with movie_app.app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(name="pooja")
+        movies = [
+            Movie(title="Elm street", release_year="1984", director="Wes Craven", rating=7.4, likes=1),
+            Movie(title="Game of Thrones", release_year="2011–2019", rating=9.2, likes=0),
+        ]
+        db.session.add_all([user, *movies])
+        db.session.flush()
+        db.session.add_all([UserMovie(user_id=user.id, movie_id=movies[0].id, rating=8.0),
+                            UserMovie(user_id=user.id, movie_id=movies[1].id)])
+        db.session.commit()
+        movie_app.data_manager.rebuild_rating_stats()
+        yield movie_app.data_manager
+        db.session.remove()
+
+
+def read_back(exported):
+    """Opens exported lines the way the import command opens a file"""
+    return io.StringIO("".join(exported), newline="")
+
+
+def table_rows():
+    """All movies and user movies, independent of their IDs"""
+    movies = db.session.query(Movie.title, Movie.release_year, Movie.director, Movie.rating,
+                              Movie.likes).order_by(Movie.title).all()
+    user_movies = (db.session.query(UserMovie.user_id, Movie.title, UserMovie.rating)
+                   .join(Movie, UserMovie.movie_id == Movie.id).order_by(Movie.title).all())
+    return movies, user_movies
+
+
+@pytest.mark.parametrize("file_format", ["ndjson", "csv"])
+def test_user_movies_round_trip(data_manager, file_format):
+    """Importing an export of a user library into the same database changes nothing"""
+    before = table_rows()
+    exported = list(serialize(data_manager.export_user_movies(1), file_format))
+    records = list(parse(read_back(exported), file_format))
+
+    assert [record["release_year"] for record in records] == [1984, "2011–2019"]
+    assert data_manager.import_records(records) == 2
+    assert table_rows() == before
+    assert data_manager.check_rating_stats() == []
+
+
+@pytest.mark.parametrize("file_format", ["ndjson", "csv"])
+def test_catalog_round_trip(data_manager, file_format):
+    """The catalog export imports into an empty database"""
+    exported = list(serialize(data_manager.export_movies(), file_format))
+    movies = table_rows()[0]
+    db.session.query(UserMovie).delete()
+    db.session.query(MovieRatingStats).delete()
+    db.session.query(Movie).delete()
+    db.session.commit()
+
+    data_manager.import_records(parse(read_back(exported), file_format))
+    assert table_rows()[0] == movies
+    assert data_manager.check_rating_stats() == []
+
+
+def test_import_keeps_ratings_of_records_without_rating(data_manager):
+    """Re-importing an export without personal ratings doesn't remove them"""
+    records = list(parse(read_back(serialize(data_manager.export_user_movies(1), "ndjson")),
+                         "ndjson"))
+    for record in records:
+        record["personal_rating"] = None
+
+    data_manager.import_records(records)
+    assert [rating for _, _, rating in table_rows()[1]] == [8.0, None]
+    assert data_manager.check_rating_stats() == []
+
+
+def test_invalid_record_reports_the_committed_batches(data_manager):
+    """Batches before an invalid record stay committed and the error says how many rows"""
+    lines = ['{"title": "A1"}', '{"title": "A2"}', '{"title": "A3", "user_id": 1, "personal_rating": "x"}']
+    with pytest.raises(PartialImportError, match="line 3") as error:
+        data_manager.import_records(parse(lines, "ndjson"), batch_size=1)
+
+    assert error.value.imported == 2
+    assert [title for title, *_ in table_rows()[0]] == ["A1", "A2", "Elm street", "Game of Thrones"]
+
+
+def test_import_into_another_user_keeps_names(data_manager):
+    """user_id moves an exported library into another user's library, names stay unchanged"""
+    db.session.add(User(name="alex"))
+    db.session.commit()
+    records = list(data_manager.export_user_movies(1))
+
+    assert data_manager.import_records(records, user_id=2) == 2
+    assert table_rows()[1] == [(1, "Elm street", 8.0), (2, "Elm street", 8.0),
+                               (1, "Game of Thrones", None), (2, "Game of Thrones", None)]
+    assert [user.name for user in db.session.query(User).order_by(User.id)] == ["pooja", "alex"]
+    assert data_manager.check_rating_stats() == []
+
+
+def test_same_user_movie_in_several_batches(data_manager):
+    """A user movie repeated across batches ends up as one row with the last rating"""
+    records = [
+        {"user_id": 1, "user_name": "pooja", "title": "Elm street", "release_year": 1984,
+         "personal_rating": 5.0},
+        {"user_id": 1, "user_name": "pooja", "title": "Elm street", "release_year": 1984},
+        {"user_id": 3, "user_name": "sam", "title": "Alien", "release_year": 1979,
+         "personal_rating": 6.0},
+        {"user_id": 1, "user_name": "pooja", "title": "Elm street", "release_year": 1984,
+         "personal_rating": 9.0},
+        {"user_id": 3, "user_name": "sam", "title": "Alien", "release_year": 1979,
+         "personal_rating": 7.0},
+    ]
+
+    assert data_manager.import_records(records, batch_size=1) == 5
+    assert table_rows()[1] == [(3, "Alien", 7.0), (1, "Elm street", 9.0),
+                               (1, "Game of Thrones", None)]
+    assert db.session.query(Movie).count() == 3
+    assert db.session.get(User, 3).name == "sam"
+    assert data_manager.check_rating_stats() == []
+
+
+def test_new_user_needs_a_name(data_manager):
+    with pytest.raises(PartialImportError, match="user_name") as error:
+        data_manager.import_records([{"user_id": 5, "title": "Alien"}])
+
+    assert error.value.imported == 0
+    assert db.session.get(User, 5) is None
+    assert db.session.query(Movie).count() == 2
+
+
+def test_export_endpoints(data_manager):
+    client = movie_app.app.test_client()
+
+    response = client.get("/users/1/export?format=csv")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert "user_1_movies.csv" in response.headers["Content-Disposition"]
+    records = list(parse(read_back([response.get_data(as_text=True)]), "csv"))
+    assert [(record["title"], record["personal_rating"]) for record in records] == [
+        ("Elm street", 8.0), ("Game of Thrones", None)]
+
+    response = client.get("/movies/export")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["title"] for line in lines] == ["Elm street", "Game of Thrones"]
+
+
+@pytest.mark.parametrize("url", ["/users/99/export", "/movies/export?format=xml"])
+def test_export_endpoints_redirect_to_404(data_manager, url):
+    response = movie_app.app.test_client().get(url)
+    assert response.status_code == 302
+    assert response.headers["Location"] == "/404"
+
+
+def test_import_command(data_manager, tmp_path):
+    source = tmp_path / "library.csv"
+    source.write_text("".join(serialize(
+        [{"user_id": 1, "user_name": "pooja", "title": "Alien", "release_year": 1979,
+          "personal_rating": 6.5}], "csv")), encoding="utf-8", newline="")
+
+    result = movie_app.app.test_cli_runner().invoke(args=["import-movies", str(source)])
+    assert result.exit_code == 0, result.output
+    assert "Imported 1 rows" in result.output and "rows/s" in result.output
+    assert (1, "Alien", 6.5) in table_rows()[1]
+    assert data_manager.check_rating_stats() == []
+
+
+def test_import_command_reports_committed_rows(data_manager, tmp_path):
+    source = tmp_path / "library.ndjson"
+    source.write_text('{"title": "A1"}\n{"title": "A2", "personal_rating": 11}\n', encoding="utf-8")
+
+    result = movie_app.app.test_cli_runner().invoke(
+        args=["import-movies", str(source), "--batch-size", "1"])
+    assert result.exit_code == 1
+    assert "line 2" in result.output and "1 rows imported before the error" in result.output
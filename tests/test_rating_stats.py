@@ -0,0 +1,144 @@
+import sqlite3
+import pytest
+from flask import Flask
+from data_manager.SQLite_data_manager import SQLiteDataManager
+from data_manager.data_models import db, Movie, User, UserMovie, MovieRatingStats
+
+
+@pytest.fixture
+def data_manager(tmp_path):
+    """Data manager on a database where two users share two movies, none rated yet"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'movies.sqlite'}"
+    manager = SQLiteDataManager(app)
+    with app.app_context():
+        db.create_all()
+        users = [User(name="pooja"), User(name="alex")]
+        movies = [Movie(title="Elm street", release_year=1984, rating=7.4,
+                        rating_stats=MovieRatingStats()),
+                  Movie(title="The grudge", release_year=2004, rating=5.9,
+                        rating_stats=MovieRatingStats())]
+        db.session.add_all([*users, *movies])
+        db.session.flush()
+        db.session.add_all([UserMovie(user_id=user.id, movie_id=movie.id)
+                            for user in users for movie in movies])
+        db.session.commit()
+        yield manager
+
+
+def stats(movie_id):
+    """Stored aggregates of a movie as (count, sum, mean, histogram)"""
+    db.session.expire_all()
+    row = db.session.get(MovieRatingStats, movie_id)
+    return row.rating_count, row.rating_sum, row.rating_mean, row.histogram
+
+
+def histogram(**buckets):
+    """Histogram with the given bucket counts, e.g. histogram(b7=1)"""
+    return [buckets.get(f"b{n}", 0) for n in range(10)]
+
+
+def test_rating_updates_count_sum_mean_and_histogram(data_manager):
+    data_manager.update_movie(1, 1, "7.5")
+    assert stats(1) == (1, 7.5, 7.5, histogram(b7=1))
+
+    data_manager.update_movie(1, 2, "6")
+    assert stats(1) == (2, 13.5, 6.75, histogram(b6=1, b7=1))
+    assert stats(2) == (0, 0.0, None, histogram())
+    assert data_manager.check_rating_stats() == []
+
+
+def test_rerating_moves_the_rating_to_another_bucket(data_manager):
+    data_manager.update_movie(1, 1, "3.9")
+    data_manager.update_movie(1, 1, "8")
+
+    assert stats(1) == (1, 8.0, 8.0, histogram(b8=1))
+    assert data_manager.check_rating_stats() == []
+
+
+def test_clearing_a_rating_removes_it(data_manager):
+    data_manager.update_movie(1, 1, "4")
+    data_manager.update_movie(1, 2, "6")
+    data_manager.update_movie(1, 1, "")
+
+    assert data_manager.get_user_rating(1, 1) is None
+    assert stats(1) == (1, 6.0, 6.0, histogram(b6=1))
+    assert data_manager.check_rating_stats() == []
+
+
+def test_maximum_rating_falls_into_the_last_bucket(data_manager):
+    data_manager.update_movie(1, 1, "10")
+    data_manager.update_movie(1, 2, "0")
+
+    assert stats(1) == (2, 10.0, 5.0, histogram(b0=1, b9=1))
+    assert data_manager.check_rating_stats() == []
+
+
+@pytest.mark.parametrize("rating", ["-1", "10.1", "great"])
+def test_invalid_ratings_are_rejected(data_manager, rating):
+    with pytest.raises(ValueError):
+        data_manager.update_movie(1, 1, rating)
+    assert stats(1) == (0, 0.0, None, histogram())
+
+
+def test_delete_movie_drops_the_users_rating(data_manager):
+    data_manager.update_movie(1, 1, "9")
+    data_manager.update_movie(1, 2, "5")
+    data_manager.delete_movie(1, 1)
+
+    assert stats(1) == (1, 5.0, 5.0, histogram(b5=1))
+    assert data_manager.check_rating_stats() == []
+
+
+def test_delete_user_drops_all_their_ratings(data_manager):
+    data_manager.update_movie(1, 1, "9")
+    data_manager.update_movie(2, 1, "2")
+    data_manager.update_movie(1, 2, "5")
+    data_manager.delete_user(1)
+
+    assert stats(1) == (1, 5.0, 5.0, histogram(b5=1))
+    assert stats(2) == (0, 0.0, None, histogram())
+    assert data_manager.check_rating_stats() == []
+
+
+def test_rebuild_repairs_corrupted_stats(data_manager):
+    data_manager.update_movie(1, 1, "7")
+    data_manager.update_movie(2, 2, "2")
+    db.session.execute(db.update(MovieRatingStats).where(MovieRatingStats.movie_id == 1)
+                       .values(rating_count=5, rating_sum=1.0, bucket_3=4))
+    db.session.execute(db.delete(MovieRatingStats).where(MovieRatingStats.movie_id == 2))
+    db.session.commit()
+
+    assert data_manager.check_rating_stats() == [1, 2]
+    assert data_manager.rebuild_rating_stats() == 2
+    assert data_manager.check_rating_stats() == []
+    assert stats(1) == (1, 7.0, 7.0, histogram(b7=1))
+    assert stats(2) == (1, 2.0, 2.0, histogram(b2=1))
+
+
+def test_migrate_updates_a_database_without_personal_ratings(tmp_path):
+    path = tmp_path / "old.sqlite"
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE users (id INTEGER NOT NULL, name VARCHAR NOT NULL, PRIMARY KEY (id));
+        CREATE TABLE movies (id INTEGER NOT NULL, title VARCHAR NOT NULL, release_year INTEGER,
+            director VARCHAR, rating FLOAT NOT NULL, poster VARCHAR, link VARCHAR, likes INTEGER,
+            PRIMARY KEY (id));
+        CREATE TABLE user_movies (id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+            movie_id INTEGER NOT NULL, PRIMARY KEY (id));
+        INSERT INTO users VALUES (1, 'pooja');
+        INSERT INTO movies VALUES (1, 'Elm street', 1984, NULL, 7.4, NULL, NULL, 0);
+        INSERT INTO user_movies VALUES (1, 1, 1);
+    """)
+    connection.close()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    manager = SQLiteDataManager(app)
+    with app.app_context():
+        assert manager.migrate_rating_stats() == 1
+        assert manager.migrate_rating_stats() == 1
+        assert [movie.title for movie in manager.get_all_movies()] == ["Elm street"]
+        manager.update_movie(1, 1, "8")
+        assert stats(1) == (1, 8.0, 8.0, histogram(b8=1))
+        assert manager.check_rating_stats() == []